@@ -1,17 +1,19 @@
 #!/usr/bin/python3
 import argparse
+import base64
 import datetime
 import logging
 import os
+import queue
 import signal
 import smtplib
-import socket
 import sys
-from email import encoders
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
+import threading
+import time
+from email.message import EmailMessage, MIMEPart
 
-from PIL import Image
+import numpy as np
+from numba import njit
 from picamera2 import Picamera2, Preview
 from picamera2.encoders import H264Encoder
 from picamera2.outputs import CircularOutput
@@ -20,6 +22,23 @@ from picamera2.outputs import CircularOutput
 logging.getLogger("picamera2").disabled = True
 
 
+@njit(cache=True, fastmath=True)
+def mean_abs_diff(frame, previous_frame):
+    """
+    Returns the mean absolute difference of the pixels of two frames.
+
+    :param frame: uint8 frame of shape (height, width)
+    :param previous_frame: uint8 frame of the same shape to compare against
+    """
+    acc = 0
+    for y in range(frame.shape[0]):
+        for x in range(frame.shape[1]):
+            # widen before subtracting, the pixels are unsigned
+            acc += abs(np.int32(frame[y, x]) - np.int32(previous_frame[y, x]))
+
+    return acc / frame.size
+
+
 def command_line_handler(signum, frame):
     res = input("Ctrl-c was pressed. Do you really want to exit? y/n ")
     if res == 'y':
@@ -49,8 +68,8 @@ def parse_command_line_arguments():
                         required=False)
     parser.add_argument('--lores-height', type=int, default=240, help='camera resolution height for low resolution',
                         required=False)
-    parser.add_argument('--min-pixel-diff', type=float, default=7.2,
-                        help='minimum number of pixel changes to detect motion (determined with numpy by calculating the mean of the squared pixel difference between two frames)',
+    parser.add_argument('--min-pixel-diff', type=float, default=3.0,
+                        help='minimum pixel change to detect motion (mean absolute difference of the pixels of two consecutive frames)',
                         required=False)
     parser.add_argument('--capture-lores', help='enables capture of lores buffer', action='store_true')
     parser.add_argument('--recording-dir', default='./recordings/', help='directory to store recordings',
@@ -73,6 +92,12 @@ def parse_command_line_arguments():
 class MotionDetector:
     """This class contains the main logic for motion detection."""
     __MAX_TIME_SINCE_LAST_MOTION_DETECTION_SECONDS = 5.0
+    __FRAME_QUEUE_SIZE = 2
+    __DOWNSAMPLE_STEP = 4
+    # only every n-th frame is analysed while not recording
+    __FRAME_SKIP = 3
+    # multiple of 57 bytes, so that every chunk encodes to complete 76 character base64 lines
+    __ATTACHMENT_CHUNK_SIZE = 57 * 1150
 
     def __init__(self, args: argparse.Namespace):
         """MotionDetector
@@ -84,6 +109,11 @@ class MotionDetector:
         self.__encoding = False
         self.__start_time_of_last_recording = None
         self.__time_of_last_motion_detection = None
+        self.__recording_file_path = None
+        self.__previous_frame = None
+        self.__frame_idx = 0
+        self.__frames = queue.Queue(maxsize=self.__FRAME_QUEUE_SIZE)
+        self.__free_frames = queue.Queue()
 
         self.__zoom_factor = args.zoom
         self.__lores_width = args.lores_width
@@ -106,90 +136,129 @@ class MotionDetector:
         self.__email_password = args.email_password
         self.__smtp_server = args.smtp_server
         self.__smtp_port = args.smtp_port
+        self.__smtp = None
 
         self.__set_up_camera(args.preview)
 
     def start(self):
         """
-        Starts the camera and runs the loop.
+        Starts the camera, the capture thread and runs the loop.
         """
         self.__picam2.start()
         self.__picam2.start_encoder()
 
         self.__set_zoom_factor()
 
+        threading.Thread(target=self.__capture_frames, daemon=True).start()
         self.__loop()
 
-    def __loop(self):
+    def __capture_frames(self):
         """
-        Runs the actual motion detection loop that, optionally, triggers sends the recording via email.
+        Captures frames and hands them over to the motion detection loop. Drops the oldest frame if the loop falls behind.
+
+        The ISP statistics are not used instead of the frames: Picamera2 does not report a luminance histogram in the
+        request metadata, and a histogram could not tell where in the frame pixels changed anyway.
         """
-        w, h = self.__lsize
-        previous_frame = None
+        w, h = self.__capture_size
+        step = self.__DOWNSAMPLE_STEP
+        stream = "lores" if self.__capture_lores else "main"
 
         while True:
+            frame = self.__free_frames.get()
             try:
-                current_frame = self.__picam2.capture_buffer("lores" if self.__capture_lores else "main")
-                current_frame = current_frame[:w * h].reshape(h, w)
-                if previous_frame is not None:
-                    hist_diff = self.__calculate_histogram_difference(current_frame, previous_frame)
-                    if hist_diff > self.__min_pixel_diff and not self.__is_max_recording_length_exceeded() and not self.__encoding:
-                        if not self.__encoding:
-                            self.__start_time_of_last_recording = datetime.datetime.now()
-                            logging.info(f"start recording of new recording: {self.__start_time_of_last_recording}")
-                            self.__start_recording()
-                        self.__time_of_last_motion_detection = datetime.datetime.now()
-                    elif self.__is_max_recording_length_exceeded():
-                        logging.info(
-                            f"max recording time exceeded after {(datetime.datetime.now() - self.__start_time_of_last_recording).total_seconds()} seconds")
-                        self.__write_recording_to_file()
-                    else:
-                        if self.__is_max_time_since_last_motion_detection_exceeded():
-                            logging.info("max time since last motion detection exceeded")
-                            self.__write_recording_to_file()
-                previous_frame = current_frame
+                with self.__picam2.captured_request() as request:
+                    # copy a downsampled Y plane, the camera buffer is reused as soon as the request is released
+                    np.copyto(frame, request.make_array(stream)[:h:step, :w:step])
             except Exception as e:
-                logging.error(f"An error occurred in the motion detection loop: {e}")
+                logging.error(f"An error occurred while capturing a frame: {e}")
+                self.__free_frames.put(frame)
                 continue
 
-    def __calculate_histogram_difference(self, current_frame, previous_frame):
-        current_image = Image.fromarray(current_frame)
-        previous_image = Image.fromarray(previous_frame)
-
-        current_hist = current_image.histogram()
-        previous_hist = previous_image.histogram()
-
-        hist_diff = sum([abs(c - p) for c, p in zip(current_hist, previous_hist)]) / len(current_hist)
-
-        return hist_diff
+            try:
+                self.__frames.put_nowait(frame)
+            except queue.Full:
+                try:
+                    self.__free_frames.put(self.__frames.get_nowait())
+                except queue.Empty:
+                    pass
+                self.__frames.put_nowait(frame)
 
-    def __is_max_recording_length_exceeded(self):
-        return self.__max_recording_length_seconds > 0 and self.__start_time_of_last_recording is not None and (
-                (
-                        datetime.datetime.now() - self.__start_time_of_last_recording).total_seconds() >= self.__max_recording_length_seconds
+    def __loop(self):
+        """
+        Runs the actual motion detection loop that, optionally, triggers sends the recording via email.
+        """
+        # capture errors are handled in the capture thread, recording and email errors where they occur
+        while True:
+            current_frame = self.__frames.get()
+            self.__frame_idx += 1
+            if not self.__encoding and self.__frame_idx % self.__FRAME_SKIP:
+                # keep the previous frame current, so that every diff compares consecutive frames
+                if self.__previous_frame is not None:
+                    self.__free_frames.put(self.__previous_frame)
+                self.__previous_frame = current_frame
+                continue
+            if self.__previous_frame is not None:
+                now = time.monotonic()
+                is_motion = mean_abs_diff(current_frame, self.__previous_frame) > self.__min_pixel_diff
+                if self.__is_max_recording_length_exceeded(now):
+                    logging.info(f"max recording time exceeded after {now - self.__start_time_of_last_recording} seconds")
+                    self.__write_recording_to_file()
+                elif self.__is_max_time_since_last_motion_detection_exceeded(now):
+                    logging.info("max time since last motion detection exceeded")
+                    self.__write_recording_to_file()
+                elif is_motion and not self.__encoding:
+                    self.__start_time_of_last_recording = now
+                    self.__start_recording()
+                if is_motion:
+                    self.__time_of_last_motion_detection = now
+                self.__free_frames.put(self.__previous_frame)
+            self.__previous_frame = current_frame
+
+    def __is_max_recording_length_exceeded(self, now):
+        return self.__encoding and self.__max_recording_length_seconds > 0 and (
+                now - self.__start_time_of_last_recording >= self.__max_recording_length_seconds
         )
 
-    def __is_max_time_since_last_motion_detection_exceeded(self):
-        return self.__encoding and self.__time_of_last_motion_detection is not None and \
-            ((
-                     datetime.datetime.now() - self.__time_of_last_motion_detection).total_seconds() > self.__MAX_TIME_SINCE_LAST_MOTION_DETECTION_SECONDS)
+    def __is_max_time_since_last_motion_detection_exceeded(self, now):
+        return self.__encoding and (
+                now - self.__time_of_last_motion_detection > self.__MAX_TIME_SINCE_LAST_MOTION_DETECTION_SECONDS
+        )
 
     def __start_recording(self):
-        self.__encoder.output.fileoutput = self.__get_recording_file_path()
-        self.__encoder.output.start()
+        self.__recording_file_path = self.__get_recording_file_path(datetime.datetime.now())
+        logging.info(f"start recording of new recording: {self.__recording_file_path}")
+        try:
+            # assigning the file output opens the file
+            self.__encoder.output.fileoutput = self.__recording_file_path
+            self.__encoder.output.start()
+        except OSError as e:
+            logging.error(f"Failed to start recording {self.__recording_file_path}: {e}")
+            self.__start_time_of_last_recording = None
+            self.__recording_file_path = None
+            return
         self.__encoding = True
 
     def __write_recording_to_file(self):
-        file_path = self.__get_recording_file_path()
+        file_path = self.__recording_file_path
         logging.info(f"writing file {file_path}")
-        self.__encoder.output.stop()
-        _, file_name = os.path.split(file_path)
-        self.__upload_file(file_path=file_path)
+        try:
+            # stopping the output flushes the buffered frames and closes the file
+            self.__encoder.output.stop()
+        except OSError as e:
+            logging.error(f"Failed to write recording {file_path}: {e}")
+        else:
+            _, file_name = os.path.split(file_path)
+            self.__upload_file(file_path=file_path)
         self.__encoding = False
         self.__start_time_of_last_recording = None
+        self.__recording_file_path = None
 
-    def __get_recording_file_path(self):
-        return f"{self.__recording_dir}{self.__start_time_of_last_recording.isoformat()}.h264"
+    def __get_recording_file_path(self, start_time):
+        """
+        Returns the path of a recording, named after its wall-clock start time.
+        :param start_time: datetime the recording was started at
+        """
+        return f"{self.__recording_dir}{start_time.isoformat()}.h264"
 
     def __set_up_camera(self, enable_preview):
         """
@@ -203,6 +272,15 @@ class MotionDetector:
             main={"size": (self.__width, self.__height), "format": "YUV420"},
             lores={"size": self.__lsize, "format": "YUV420"})
         self.__picam2.configure(video_config)
+        # size of the stream motion is detected on
+        self.__capture_size = self.__lsize if self.__capture_lores else (self.__width, self.__height)
+
+        # one frame buffer for every queue slot, the current and previous frame of the loop and the capture thread
+        capture_width, capture_height = self.__capture_size
+        step = self.__DOWNSAMPLE_STEP
+        frame_shape = ((capture_height + step - 1) // step, (capture_width + step - 1) // step)
+        for _ in range(self.__FRAME_QUEUE_SIZE + 3):
+            self.__free_frames.put(np.empty(frame_shape, np.uint8))
 
         if enable_preview:
             self.__picam2.start_preview(Preview.QTGL, x=self.__preview_x, y=self.__preview_y,
@@ -229,7 +307,10 @@ class MotionDetector:
         """
         if self.__delete_local_recordings:
             logging.info(f"Deleting local recording {file_path}")
-            os.remove(file_path)
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                logging.error(f"Failed to delete local recording {file_path}: {e}")
 
     def __send_email(self, file_path):
         """
@@ -237,24 +318,67 @@ class MotionDetector:
         :param file_path: Path of the recording to send
         """
         try:
-            msg = MIMEMultipart()
+            msg = EmailMessage()
             msg['From'] = self.__email_username
             msg['To'] = self.__recipient
             msg['Subject'] = f"Motion detected at {datetime.datetime.now()}"
+            msg.make_mixed()
+            msg.attach(self.__create_attachment(file_path))
 
-            with open(file_path, 'rb') as attachment_file:
-                attachment = MIMEBase('application', 'octet-stream')
-                attachment.set_payload(attachment_file.read())
-                encoders.encode_base64(attachment)
-                attachment.add_header('Content-Disposition', f'attachment; filename={os.path.basename(file_path)}')
-                msg.attach(attachment)
-
-            with smtplib.SMTP_SSL(self.__smtp_server, self.__smtp_port, timeout=10) as server:
-                server.login(self.__email_username, self.__email_password)
-                server.sendmail(self.__email_username, self.__recipient, msg.as_string())
-                logging.info(f"Sent email with attachment {file_path}")
-        except (smtplib.SMTPException, socket.timeout) as e:
+            self.__get_smtp_connection().send_message(msg)
+            logging.info(f"Sent email with attachment {file_path}")
+        except (smtplib.SMTPException, OSError) as e:
             logging.error(f"Failed to send email with attachment {file_path}: {e}")
+            self.__close_smtp_connection()
+
+    def __create_attachment(self, file_path):
+        """
+        Creates the base64 encoded attachment of a recording. The file is read and encoded in chunks, so that the raw
+        bytes of the recording are never held in memory as a whole; the encoded payload still is.
+        :param file_path: Path of the recording to attach
+        """
+        attachment = MIMEPart()
+        attachment['Content-Type'] = 'video/h264'
+        attachment['Content-Transfer-Encoding'] = 'base64'
+        attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(file_path))
+
+        encoded_chunks = []
+        with open(file_path, 'rb') as attachment_file:
+            while chunk := attachment_file.read(self.__ATTACHMENT_CHUNK_SIZE):
+                encoded_chunks.append(base64.encodebytes(chunk).decode('ascii'))
+        attachment.set_payload(''.join(encoded_chunks))
+
+        return attachment
+
+    def __get_smtp_connection(self):
+        """
+        Returns the SMTP connection that is kept open between emails. Connects and logs in on first use and reconnects,
+        if the server does not answer a NOOP, e.g. because it timed out the idle connection.
+        """
+        if self.__smtp is not None:
+            try:
+                code, _ = self.__smtp.noop()
+            except (smtplib.SMTPException, OSError):
+                code = None
+            if code != 250:
+                logging.info("SMTP connection is no longer usable, reconnecting")
+                self.__close_smtp_connection()
+        if self.__smtp is None:
+            self.__smtp = smtplib.SMTP_SSL(self.__smtp_server, self.__smtp_port, timeout=10)
+            self.__smtp.login(self.__email_username, self.__email_password)
+        return self.__smtp
+
+    def __close_smtp_connection(self):
+        """
+        Closes the SMTP connection, if there is one.
+        """
+        if self.__smtp is None:
+            return
+        try:
+            self.__smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.__smtp.close()
+        self.__smtp = None
 
     def __upload_file(self, file_path):
         """
@@ -267,9 +391,10 @@ class MotionDetector:
 
     def stop(self):
         """
-        Stops the encoder and exits the application.
+        Stops the encoder, closes the SMTP connection and exits the application.
         """
         self.__picam2.stop_encoder()
+        self.__close_smtp_connection()
         sys.exit(1)
 
 